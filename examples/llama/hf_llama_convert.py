@@ -16,15 +16,18 @@
 Convert huggingface GPT model. Use https://huggingface.co/gpt2 as demo.
 '''
 import argparse
+import concurrent.futures
 import configparser
 import os
+import threading
 from pathlib import Path
 
 import torch
-import torch.multiprocessing as multiprocessing
-from convert import split_and_save_weight, str_to_np_dtype
-from smoothquant import (capture_activation_range, smooth_gemm,
-                         smooth_gemm_fc1_gate)
+import transformers
+from convert import fast_tofile, split_and_save_weight
+from packaging import version
+from smoothquant import (apply_smoothing, capture_activation_range,
+                         compute_smoothers, per_channel_absmax)
 from tqdm import tqdm
 from transformers import LlamaForCausalLM, LlamaTokenizer
 from transformers.models.llama.modeling_llama import LlamaDecoderLayer
@@ -43,7 +46,7 @@ def merge_qkv_scales(q_name, hf_model, scales, llama_qkv_para):
     weight = torch.cat([q, k, v], dim=0)
 
     scales[layer_name_qkv]["x"] = scales[layer_name_q]["x"]
-    scales[layer_name_qkv]["w"] = weight.abs().max(dim=1)[0]
+    scales[layer_name_qkv]["w"] = per_channel_absmax(weight)
     print(scales[layer_name_q])
     scales[layer_name_qkv]["y"] = torch.cat([
         scales[layer_name_q]["y"], scales[layer_name_k]["y"],
@@ -54,74 +57,185 @@ def merge_qkv_scales(q_name, hf_model, scales, llama_qkv_para):
     llama_qkv_para[layer_name_qkv] = weight.transpose(0, 1)
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def smooth_llama_model(model, scales, alpha, llama_qkv_para, llama_smoother):
     # Smooth the activation and weights with smoother = $\diag{s}$
-    for name, module in model.named_modules():
-        if not isinstance(module, LlamaDecoderLayer):
-            continue
-        # qkv_proj
-        layer_name_q = name + ".self_attn.q_proj"
-        layer_name_k = name + ".self_attn.k_proj"
-        layer_name_v = name + ".self_attn.v_proj"
-        layer_name_qkv = name + ".self_attn.qkv_proj"
-
+    layers = [(name, module) for name, module in model.named_modules()
+              if isinstance(module, LlamaDecoderLayer)]
+    if not layers:
+        return
+
+    # Gather the activation and weight scales of every layer first, so the
+    # smoothers of all layers are computed in one vectorized op per GEMM
+    # instead of a few small kernels per layer.
+    act_scales = {"qkv": [], "o_proj": [], "fc1_gate": [], "down_proj": []}
+    weight_scales = {"qkv": [], "o_proj": [], "fc1_gate": [], "down_proj": []}
+    for name, module in layers:
         weight = torch.cat([
             module.self_attn.q_proj.weight, module.self_attn.k_proj.weight,
             module.self_attn.v_proj.weight
         ],
                            dim=0)
+        # see transpose_weights function
+        llama_qkv_para[name + ".self_attn.qkv_proj"] = weight.transpose(0, 1)
+
+        act_scales["qkv"].append(scales[name + ".self_attn.q_proj"]["x"])
+        weight_scales["qkv"].append(per_channel_absmax(weight, dim=0))
+
+        act_scales["o_proj"].append(scales[name + ".self_attn.o_proj"]["x"])
+        weight_scales["o_proj"].append(
+            per_channel_absmax(module.self_attn.o_proj.weight, dim=0))
+
+        act_scales["fc1_gate"].append(scales[name + ".mlp.gate_proj"]["x"])
+        weight_scales["fc1_gate"].append(
+            torch.maximum(
+                per_channel_absmax(module.mlp.gate_proj.weight, dim=0),
+                per_channel_absmax(module.mlp.up_proj.weight, dim=0)))
+
+        act_scales["down_proj"].append(scales[name + ".mlp.down_proj"]["x"])
+        weight_scales["down_proj"].append(
+            per_channel_absmax(module.mlp.down_proj.weight, dim=0))
+
+    smoothers = {
+        key: compute_smoothers(act_scales[key], weight_scales[key], alpha)
+        for key in act_scales
+    }
+
+    for i, (name, module) in enumerate(layers):
+        # qkv_proj
+        layer_name_q = name + ".self_attn.q_proj"
+        layer_name_k = name + ".self_attn.k_proj"
+        layer_name_v = name + ".self_attn.v_proj"
+        layer_name_qkv = name + ".self_attn.qkv_proj"
 
-        smoother = smooth_gemm(weight, scales[layer_name_q]["x"],
-                               module.input_layernorm.weight, None, alpha)
+        weight = llama_qkv_para[layer_name_qkv].transpose(0, 1)
+        smoother = smoothers["qkv"][i].to(weight.device)
+        apply_smoothing(smoother, weight, module.input_layernorm.weight, None,
+                        weight.dtype)
 
         scales[layer_name_qkv]["x"] = scales[layer_name_q]["x"] / smoother
-        scales[layer_name_qkv]["w"] = weight.abs().max(dim=1)[0]
+        scales[layer_name_qkv]["w"] = per_channel_absmax(weight)
         scales[layer_name_qkv]["y"] = torch.cat([
             scales[layer_name_q]["y"], scales[layer_name_k]["y"],
             scales[layer_name_v]["y"]
         ],
                                                 dim=0)
 
-        # see transpose_weights function
-        llama_qkv_para[layer_name_qkv] = weight.transpose(0, 1)
-
         # =================================================================
         layer_name = name + ".self_attn.o_proj"
-        smoother = smooth_gemm(module.self_attn.o_proj.weight,
-                               scales[layer_name]["x"], None, None, alpha)
+        weight = module.self_attn.o_proj.weight
+        smoother = smoothers["o_proj"][i].to(weight.device)
+        apply_smoothing(smoother, weight, None, None, weight.dtype)
+        # Smoothers are always stored in fp32, independent of storage_type:
+        # weight.py reads *.smoother.bin as np.float32. The smoother itself
+        # is computed in fp64, so this is a downcast, not an upcast.
         llama_smoother[layer_name] = smoother.float()
 
         scales[layer_name]["x"] = scales[layer_name]["x"] / smoother
-        scales[layer_name]["w"] = module.self_attn.o_proj.weight.abs().max(
-            dim=1)[0]
+        scales[layer_name]["w"] = per_channel_absmax(weight)
 
         # ==================================================================
         fc1_layer_name = name + ".mlp.gate_proj"
         gate_layer_name = name + ".mlp.up_proj"
 
-        smoother = smooth_gemm_fc1_gate(module.mlp.gate_proj.weight,
-                                        module.mlp.up_proj.weight,
-                                        scales[fc1_layer_name]["x"],
-                                        module.post_attention_layernorm.weight,
-                                        None, alpha)
+        fc1_weight = module.mlp.gate_proj.weight
+        gate_weight = module.mlp.up_proj.weight
+        smoother = smoothers["fc1_gate"][i].to(fc1_weight.device)
+        apply_smoothing(smoother, [fc1_weight, gate_weight],
+                        module.post_attention_layernorm.weight, None,
+                        fc1_weight.dtype)
 
         scales[fc1_layer_name]["x"] = scales[fc1_layer_name]["x"] / smoother
-        scales[fc1_layer_name]["w"] = module.mlp.gate_proj.weight.abs().max(
-            dim=1)[0]
+        scales[fc1_layer_name]["w"] = per_channel_absmax(fc1_weight)
 
         scales[gate_layer_name]["x"] = scales[gate_layer_name]["x"] / smoother
-        scales[gate_layer_name]["w"] = module.mlp.up_proj.weight.abs().max(
-            dim=1)[0]
+        scales[gate_layer_name]["w"] = per_channel_absmax(gate_weight)
 
         # ==================================================================
         layer_name = name + ".mlp.down_proj"
-        smoother = smooth_gemm(module.mlp.down_proj.weight,
-                               scales[layer_name]["x"], None, None, alpha)
+        weight = module.mlp.down_proj.weight
+        smoother = smoothers["down_proj"][i].to(weight.device)
+        apply_smoothing(smoother, weight, None, None, weight.dtype)
         llama_smoother[layer_name] = smoother.float()
         scales[layer_name]["x"] = scales[layer_name]["x"] / smoother
-        scales[layer_name]["w"] = module.mlp.down_proj.weight.abs().max(
-            dim=1)[0]
+        scales[layer_name]["w"] = per_channel_absmax(weight)
+
+
+def smoothers_to_host(llama_smoother):
+    # Copy all smoothers into pinned host buffers on a side stream, and wait
+    # only once, instead of a blocking D2H copy per smoother.
+    host_smoother = {}
+    streams = {}
+    for name, smoother in llama_smoother.items():
+        if not smoother.is_cuda:
+            host_smoother[name] = smoother
+            continue
+        if smoother.device not in streams:
+            streams[smoother.device] = torch.cuda.Stream(smoother.device)
+            streams[smoother.device].wait_stream(
+                torch.cuda.current_stream(smoother.device))
+        host_smoother[name] = torch.empty(smoother.shape,
+                                          dtype=smoother.dtype,
+                                          pin_memory=True)
+        with torch.cuda.stream(streams[smoother.device]):
+            host_smoother[name].copy_(smoother, non_blocking=True)
+    for stream in streams.values():
+        stream.synchronize()
+    return host_smoother
+
+
+# Saves weights on a thread pool while the caller keeps copying weights to
+# the host. At most 2 * num_threads weights are in flight, which bounds host
+# memory. With num_threads <= 1 weights are saved inline (simpler for debug).
+class WeightSaver:
+
+    def __init__(self, num_threads):
+        self.executor = None
+        if num_threads > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=num_threads)
+            self.in_flight = threading.BoundedSemaphore(2 * num_threads)
+        self.futures = []
+
+    def _raise_failures(self):
+        # re-raise the first failure of a finished saving thread, and drop
+        # the futures that completed fine
+        pending = []
+        for future in self.futures:
+            if not future.done():
+                pending.append(future)
+            elif future.exception() is not None:
+                raise future.exception()
+        self.futures = pending
+
+    def submit(self, *starmap_arg):
+        self.submit_fn(split_and_save_weight, *starmap_arg)
+
+    def submit_fn(self, fn, *args):
+        if self.executor is None:
+            fn(*args)
+            return
+        self._raise_failures()
+        self.in_flight.acquire()
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.executor is None:
+            return
+        if exc_type is not None:
+            # don't start saving the remaining weights, and let the original
+            # error propagate instead of a saving thread's
+            for future in self.futures:
+                future.cancel()
+        self.executor.shutdown(wait=True)
+        if exc_type is None:
+            for future in self.futures:
+                future.result()
 
 
 def gpt_to_ft_name(orig_name):
@@ -158,20 +272,38 @@ def gpt_to_ft_name(orig_name):
 
 # LLaMA uses nn.Linear for these following ops whose weight matrix is transposed compared to gpt2.
 # In order to use the preprocess codes of gpt2, we transpose them firstly.
+_WEIGHTS_TO_TRANSPOSE = frozenset(
+    ("o_proj", "gate_proj", "down_proj", "up_proj"))
+
+
 def transpose_weights(hf_name, param):
-    weight_to_transpose = ["o_proj", "gate_proj", "down_proj", "up_proj"]
-    if any([k in hf_name for k in weight_to_transpose]):
+    if any(k in hf_name for k in _WEIGHTS_TO_TRANSPOSE):
         if len(param.shape) == 2:
-            param = param.transpose(0, 1)
+            # contiguous() so the following D2H copy is a plain memcpy
+            # instead of a strided copy
+            param = param.t().contiguous()
     return param
 
 
+def load_hf_llama(in_file):
+    # Loaded in the default fp32, so calibration and smoothing keep their
+    # original precision.
+    kwargs = dict(device_map="auto")
+    # LLaMA supports SDPA through attn_implementation from transformers 4.36
+    # on, and only with a recent enough torch; otherwise (including the
+    # pinned transformers version) the default eager attention is used.
+    if version.parse(transformers.__version__) >= version.parse(
+            "4.36.0") and transformers.utils.is_torch_sdpa_available():
+        kwargs["attn_implementation"] = "sdpa"
+    return LlamaForCausalLM.from_pretrained(in_file, **kwargs)
+
+
 def hf_gpt_converter(args):
     infer_tp = args.tensor_parallelism
     saved_dir = Path(args.out_dir) / f"{infer_tp}-gpu"
     saved_dir.mkdir(parents=True, exist_ok=True)
 
-    model = LlamaForCausalLM.from_pretrained(args.in_file, device_map="auto")
+    model = load_hf_llama(args.in_file)
 
     act_range = {}
     llama_qkv_para = {}
@@ -181,12 +313,15 @@ def hf_gpt_converter(args):
     if args.smoothquant is not None or args.calibrate_kv_cache:
         os.environ["TOKENIZERS_PARALLELISM"] = os.environ.get(
             "TOKENIZERS_PARALLELISM", "false")
-        act_range = capture_activation_range(
-            model,
-            LlamaTokenizer.from_pretrained(args.in_file, padding_side='left'))
+        tokenizer = LlamaTokenizer.from_pretrained(args.in_file,
+                                                   padding_side='left')
+        act_range = capture_activation_range(model,
+                                             tokenizer,
+                                             cache_dir=args.calib_cache_dir)
         if args.smoothquant is not None:
             smooth_llama_model(model, act_range, args.smoothquant,
                                llama_qkv_para, llama_smoother)
+            llama_smoother = smoothers_to_host(llama_smoother)
 
     config = configparser.ConfigParser()
     config["llama"] = {}
@@ -199,7 +334,10 @@ def hf_gpt_converter(args):
     with open(saved_dir / "config.ini", 'w') as configfile:
         config.write(configfile)
 
-    storage_type = str_to_np_dtype(args.storage_type)
+    # Cast on the device before the D2H copy so that .numpy() already yields
+    # the storage dtype and no extra host-side astype() copy is needed.
+    storage_type = (torch.float16
+                    if args.storage_type == "fp16" else torch.float32)
 
     global_ft_weights = [
         'vocab_embedding.weight', 'ln_f.weight', 'lm_head.weight'
@@ -211,71 +349,72 @@ def hf_gpt_converter(args):
     if args.smoothquant is not None:
         int8_outputs = "all"
 
-    starmap_args = []
-    for name, param in model.named_parameters():
-        if "weight" not in name and "bias" not in name:
-            continue
-        ft_name = gpt_to_ft_name(name)
-
-        if name.replace(".weight", "") in llama_smoother.keys():
-            smoother = llama_smoother[name.replace(".weight", "")]
-            smoother = smoother.detach().cpu().numpy()
-            starmap_args.append(
-                (0, saved_dir, infer_tp,
-                 f"{ft_name}.smoother".replace(".weight", ""), smoother, None, {
-                     "int8_outputs": int8_outputs,
-                     "multi_query_mode": args.multi_query_mode,
-                     "local_dim": None,
-                 }))
-
-        param = transpose_weights(name, param)
-
-        param = param.detach().cpu().numpy().astype(storage_type)
-
-        if ft_name in global_ft_weights:
-            param.tofile(saved_dir / f"{ft_name}.bin")
-        elif ft_name.split('.')[-2] == 'query_key_value':
-            # Is there other ways to get local_dim? local_dim = hidden_size in llama2
-            local_dim = model.config.hidden_size if args.multi_query_mode else None
-            if args.smoothquant is None:
-                merge_qkv_scales(name, model, act_range, llama_qkv_para)
-            qkv = (0, saved_dir, infer_tp, ft_name,
-                   llama_qkv_para.get(
-                       name.replace(".weight", "").replace(
-                           ".q_proj",
-                           ".qkv_proj")).cpu().numpy().astype(storage_type),
-                   act_range.get(
-                       name.replace(".weight",
-                                    "").replace(".q_proj", ".qkv_proj")), {
-                                        "int8_outputs": int8_outputs,
-                                        "multi_query_mode":
-                                        args.multi_query_mode,
-                                        "local_dim": local_dim,
-                                    })
-            starmap_args.append(qkv)
-        elif ft_name.split('.')[-2] == 'kv':
-            continue
-        else:
-            starmap_args.append((0, saved_dir, infer_tp, ft_name, param,
-                                 act_range.get(name.replace(".weight", "")), {
-                                     "int8_outputs": int8_outputs,
-                                     "multi_query_mode": args.multi_query_mode,
-                                     "local_dim": None,
-                                 }))
-
-    starmap_args = tqdm(starmap_args, desc="saving weights")
-    if args.processes > 1:
-        with multiprocessing.Pool(args.processes) as pool:
-            pool.starmap(split_and_save_weight, starmap_args)
-    else:
-        # simpler for debug situations
-        for starmap_arg in starmap_args:
-            split_and_save_weight(*starmap_arg)
+    named_parameters = [(name, param)
+                        for name, param in model.named_parameters()
+                        if "weight" in name or "bias" in name]
+    # Largest tensors first (including the vocab-sized global weights, which
+    # also go through the saver), so the saving threads get the big writes
+    # early and the small ones fill in at the end.
+    named_parameters.sort(key=lambda name_param: -name_param[1].numel())
+
+    with WeightSaver(args.processes) as saver:
+        for name, param in tqdm(named_parameters, desc="saving weights"):
+            ft_name = gpt_to_ft_name(name)
+            base_name = name[:-len(".weight")] if name.endswith(
+                ".weight") else name
+            ft_tail = ft_name.split('.')[-2]
+
+            if base_name in llama_smoother:
+                # smoothers are host tensors already (see smoothers_to_host),
+                # so this is a zero-copy view
+                smoother = llama_smoother[base_name].numpy()
+                saver.submit(
+                    0, saved_dir, infer_tp,
+                    f"{ft_name}.smoother".replace(".weight", ""), smoother,
+                    None, {
+                        "int8_outputs": int8_outputs,
+                        "multi_query_mode": args.multi_query_mode,
+                        "local_dim": None,
+                    })
+
+            if ft_tail == 'kv':
+                # k_proj and v_proj are saved as part of the merged qkv
+                continue
+            elif ft_tail == 'query_key_value':
+                # Is there other ways to get local_dim? local_dim = hidden_size in llama2
+                local_dim = model.config.hidden_size if args.multi_query_mode else None
+                if args.smoothquant is None:
+                    merge_qkv_scales(name, model, act_range, llama_qkv_para)
+                qkv_name = base_name.replace(".q_proj", ".qkv_proj")
+                qkv = llama_qkv_para.get(qkv_name)
+                saver.submit(
+                    0, saved_dir, infer_tp, ft_name,
+                    qkv.to(storage_type).cpu().numpy(), act_range.get(qkv_name),
+                    {
+                        "int8_outputs": int8_outputs,
+                        "multi_query_mode": args.multi_query_mode,
+                        "local_dim": local_dim,
+                    })
+                continue
+
+            param = transpose_weights(name, param)
+
+            param = param.detach().to(storage_type).cpu().numpy()
+
+            if ft_name in global_ft_weights:
+                saver.submit_fn(fast_tofile, param,
+                                saved_dir / f"{ft_name}.bin")
+            else:
+                saver.submit(
+                    0, saved_dir, infer_tp, ft_name, param,
+                    act_range.get(base_name), {
+                        "int8_outputs": int8_outputs,
+                        "multi_query_mode": args.multi_query_mode,
+                        "local_dim": None,
+                    })
 
 
 if __name__ == "__main__":
-    torch.multiprocessing.set_start_method("spawn")
-
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument('--out-dir',
@@ -297,7 +436,7 @@ if __name__ == "__main__":
         "--processes",
         "-p",
         type=int,
-        help="How many processes to spawn for conversion (default: 4)",
+        help="How many threads to use for saving weights (default: 4)",
         default=4)
     parser.add_argument(
         "--calibrate-kv-cache",
@@ -319,6 +458,12 @@ if __name__ == "__main__":
                         type=str,
                         default="fp32",
                         choices=["fp32", "fp16"])
+    parser.add_argument(
+        "--calib-cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache the tokenized calibration dataset in, so"
+        " that later runs can skip tokenization.")
     parser.add_argument("--multi-query-mode",
                         action="store_true",
                         help="Use multi-query-attention.")
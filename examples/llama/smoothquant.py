@@ -18,7 +18,12 @@ Utilities for SmoothQuant models
 
 import copy
 import functools
+import hashlib
+import json
+import os
+import tempfile
 from collections import defaultdict
+from pathlib import Path
 
 import torch
 import torch.nn as nn
@@ -26,6 +31,12 @@ from tqdm import tqdm
 from transformers.pytorch_utils import Conv1D
 
 
+def per_channel_absmax(weight, dim=1):
+    # Equivalent to weight.abs().max(dim=dim)[0], but reduces in a single pass
+    # without materializing an abs() copy of the weight.
+    return torch.linalg.vector_norm(weight, ord=float('inf'), dim=dim)
+
+
 @torch.no_grad()
 def apply_smoothing(scales,
                     gemm_weights,
@@ -49,6 +60,18 @@ def apply_smoothing(scales,
         gemm.mul_(scales.view(1, -1)).to(dtype)
 
 
+@torch.no_grad()
+def compute_smoothers(act_scales, weight_scales, alpha):
+    # Smoothers s = act^alpha / w^(1 - alpha) (as in smooth_gemm) for a list
+    # of GEMMs at once, from their stacked [num_gemms, hidden] activation and
+    # weight scales.
+    device = weight_scales[0].device
+    act_scales = torch.stack([a.to(device) for a in act_scales]).to(float)
+    weight_scales = torch.stack([w.to(device) for w in weight_scales])
+    return (act_scales.pow(alpha) /
+            weight_scales.pow(1 - alpha)).clamp(min=1e-5)
+
+
 @torch.no_grad()
 def smooth_gemm(gemm_weights,
                 act_scales,
@@ -144,8 +167,99 @@ def smooth_ln_fcs(ln, fcs, act_scales, alpha=0.5):
     return scales
 
 
-@torch.no_grad()
-def capture_activation_range(model, tokenizer, num_samples=512, seq_len=512):
+# Bump whenever tokenize_calibration_dataset changes how samples are built,
+# so that stale cached ids are not reused.
+CALIB_CACHE_FORMAT = "cnn_dailymail-tldr-v1"
+
+
+def tokenize_calibration_dataset(tokenizer,
+                                 num_samples=512,
+                                 test_token_num=923):
+    from datasets import load_dataset
+    dataset_cnn = load_dataset("ccdv/cnn_dailymail", '3.0.0')
+
+    input_ids = []
+    for i in range(num_samples):
+        datapoint = dataset_cnn['train'][i:i + 1]
+        line = copy.copy(datapoint['article'])
+        line[0] = line[0] + ' TL;DR: '
+        line[0] = line[0].strip()
+        line[0] = line[0].replace(" n't", "n't")
+        line_encoded = tokenizer(line,
+                                 return_tensors="pt",
+                                 padding=True,
+                                 truncation=True)["input_ids"].type(torch.int64)
+        input_ids.append(line_encoded[:, -test_token_num:])
+    return input_ids
+
+
+def load_calibration_dataset(tokenizer,
+                             num_samples=512,
+                             test_token_num=923,
+                             cache_dir=None):
+    """
+    Tokenize the calibration dataset. If cache_dir is given, the token ids
+    are cached there, keyed by the tokenizer vocabulary, the tokenizer
+    settings and the sampling parameters, and reloaded on later runs.
+    """
+    if cache_dir is None:
+        return tokenize_calibration_dataset(tokenizer, num_samples,
+                                            test_token_num)
+
+    # Everything that changes the token ids: init kwargs such as
+    # add_bos_token, add_eos_token and legacy (minus file paths, which differ
+    # between copies of the same tokenizer), plus the settings used by
+    # padding and truncation.
+    tokenizer_settings = {
+        k: v
+        for k, v in tokenizer.init_kwargs.items()
+        if not k.endswith("_file") and k != "name_or_path"
+    }
+    for attr in ("padding_side", "truncation_side", "model_max_length",
+                 "pad_token", "add_bos_token", "add_eos_token", "legacy"):
+        tokenizer_settings[attr] = getattr(tokenizer, attr, None)
+    tokenizer_settings["class"] = type(tokenizer).__name__
+
+    key = hashlib.sha256()
+    key.update(CALIB_CACHE_FORMAT.encode("utf-8"))
+    key.update(
+        json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf-8"))
+    key.update(
+        json.dumps(tokenizer_settings, sort_keys=True,
+                   default=str).encode("utf-8"))
+    key.update(
+        f"ccdv/cnn_dailymail:3.0.0:{num_samples}:{test_token_num}".encode(
+            "utf-8"))
+    cache_path = Path(cache_dir) / f"calib_{key.hexdigest()}.pt"
+
+    if cache_path.exists():
+        # the cache directory is user supplied, only load plain tensors
+        return torch.load(cache_path, weights_only=True)["input_ids"]
+
+    input_ids = tokenize_calibration_dataset(tokenizer, num_samples,
+                                             test_token_num)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # Write to a temporary file and rename it into place, so an interrupted
+    # or concurrent conversion never leaves a partial file at the cached key.
+    with tempfile.NamedTemporaryFile(dir=cache_path.parent,
+                                     suffix=".tmp",
+                                     delete=False) as f:
+        tmp_path = f.name
+    try:
+        torch.save({"input_ids": input_ids}, tmp_path)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    return input_ids
+
+
+@torch.inference_mode()
+def capture_activation_range(model,
+                             tokenizer,
+                             num_samples=512,
+                             seq_len=512,
+                             cache_dir=None):
     model.eval()
     next(model.parameters()).device
     act_scales = defaultdict(lambda: {"x": None, "y": None, "w": None})
@@ -155,8 +269,10 @@ def capture_activation_range(model, tokenizer, num_samples=512, seq_len=512):
 
     def stat_tensor(name, tensor, act_scales, key):
         hidden_dim = tensor.shape[-1]
-        tensor = tensor.view(-1, hidden_dim).abs().detach()
-        comming_max = torch.max(tensor, dim=0)[0].float()
+        tensor = tensor.view(-1, hidden_dim).detach()
+        # Fused abs + max, so no fp32 or abs() copy of the activation is
+        # made. Only the reduced [hidden] vector is upcast.
+        comming_max = per_channel_absmax(tensor, dim=0).float()
 
         if act_scales[name][key] is None:
             act_scales[name][key] = comming_max
@@ -171,8 +287,11 @@ def capture_activation_range(model, tokenizer, num_samples=512, seq_len=512):
         stat_tensor(name, y, act_scales, "y")
 
         if act_scales[name]["w"] is None:
-            act_scales[name]["w"] = m.weight.abs().clip(1e-8,
-                                                        None).max(dim=1)[0]
+            act_scales[name]["w"] = per_channel_absmax(m.weight).clip(
+                1e-8, None)
+
+    calib_input_ids = load_calibration_dataset(tokenizer, num_samples,
+                                               test_token_num, cache_dir)
 
     hooks = []
     for name, m in model.named_modules():
@@ -181,20 +300,7 @@ def capture_activation_range(model, tokenizer, num_samples=512, seq_len=512):
                 m.register_forward_hook(
                     functools.partial(stat_input_hook, name=name)))
 
-    from datasets import load_dataset
-    dataset_cnn = load_dataset("ccdv/cnn_dailymail", '3.0.0')
-
-    for i in tqdm(range(num_samples), desc="calibrating model"):
-        datapoint = dataset_cnn['train'][i:i + 1]
-        line = copy.copy(datapoint['article'])
-        line[0] = line[0] + ' TL;DR: '
-        line[0] = line[0].strip()
-        line[0] = line[0].replace(" n't", "n't")
-        line_encoded = tokenizer(line,
-                                 return_tensors="pt",
-                                 padding=True,
-                                 truncation=True)["input_ids"].type(torch.int64)
-        line_encoded = line_encoded[:, -test_token_num:]
+    for line_encoded in tqdm(calib_input_ids, desc="calibrating model"):
         line_encoded = line_encoded.cuda()
         model(line_encoded)
 
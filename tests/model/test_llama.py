@@ -32,6 +32,7 @@ from tensorrt_llm._utils import str_dtype_to_trt
 from tensorrt_llm.layers import PositionEmbeddingType
 from tensorrt_llm.network import net_guard
 from tensorrt_llm.plugin.plugin import ContextFMHAType
+from tensorrt_llm.quantization import QuantMode
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '../..'))
 from examples.llama.weight import load_from_hf_llama
@@ -44,14 +45,63 @@ class TestLLaMA(unittest.TestCase):
     EOS_TOKEN = 2
     PAD_TOKEN = 2
 
-    def _gen_tensorrt_llm_network(self, network, hf_llama,
-                                  llama_config: LlamaConfig, batch_size,
-                                  beam_width, input_len, output_len, dtype,
-                                  rank, tensor_parallel):
+    # HF reference models shared by the parameterized variants, keyed by
+    # (config, seed). Model init dominates the runtime of the small shapes
+    # used here, and many variants only differ in TRT-LLM build options.
+    _hf_llama_cache = {}
+    # KV cache buffers reused across test variants, keyed by
+    # (num_layers, shape, dtype), to avoid a cudaMalloc per layer per variant.
+    _kv_cache_pool = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._hf_llama_cache.clear()
+        cls._kv_cache_pool.clear()
+
+    @classmethod
+    def _gen_hf_llama(cls, llama_config: LlamaConfig, seed):
+        key = (llama_config.to_json_string(), seed)
+        if key not in cls._hf_llama_cache:
+            torch.manual_seed(seed)
+            hf_llama = LlamaForCausalLM(llama_config).cuda()
+            # Keep the RNG state after init, so inputs drawn afterwards are
+            # the same whether or not the model came from the cache.
+            cls._hf_llama_cache[key] = (hf_llama, torch.get_rng_state())
+        hf_llama, rng_state = cls._hf_llama_cache[key]
+        torch.set_rng_state(rng_state)
+        return hf_llama
+
+    @classmethod
+    def _get_kv_cache_buffers(cls, num_layers, shape, dtype):
+        key = (num_layers, tuple(shape), dtype)
+        if key not in cls._kv_cache_pool:
+            cls._kv_cache_pool[key] = [
+                torch.zeros(shape, dtype=dtype, device='cuda')
+                for _ in range(num_layers)
+            ]
+        else:
+            for buffer in cls._kv_cache_pool[key]:
+                buffer.zero_()
+        return cls._kv_cache_pool[key]
+
+    def _gen_tensorrt_llm_network(self,
+                                  network,
+                                  hf_llama,
+                                  llama_config: LlamaConfig,
+                                  batch_size,
+                                  beam_width,
+                                  input_len,
+                                  output_len,
+                                  dtype,
+                                  rank,
+                                  tensor_parallel,
+                                  kv_cache_amax=None):
         list(range(tensor_parallel))
 
         with net_guard(network):
             kv_dtype = str_dtype_to_trt(dtype)
+            quant_mode = QuantMode.from_description(
+                use_int8_kv_cache=kv_cache_amax is not None)
 
             # Initialize model
             tensorrt_llm_llama = tensorrt_llm.models.LLaMAForCausalLM(
@@ -67,6 +117,7 @@ class TestLLaMA(unittest.TestCase):
                 position_embedding_type=PositionEmbeddingType.rope_gpt_neox,
                 mapping=tensorrt_llm.Mapping(world_size=tensor_parallel,
                                              tp_size=tensor_parallel),
+                quant_mode=quant_mode,
             )
             load_from_hf_llama(tensorrt_llm_llama,
                                hf_llama,
@@ -75,6 +126,17 @@ class TestLLaMA(unittest.TestCase):
                                    world_size=tensor_parallel,
                                    rank=rank,
                                    tp_size=tensor_parallel))
+            if kv_cache_amax is not None:
+                # Symmetric per-tensor INT8 scales, using the same formula
+                # as weight.py (127 / amax and amax / 127). Here amax is the
+                # post-RoPE K/V absmax, whereas hf_llama_convert.py uses the
+                # pre-RoPE qkv_proj output absmax, which includes Q.
+                for layer, amax in zip(tensorrt_llm_llama.layers,
+                                       kv_cache_amax):
+                    layer.attention.kv_orig_quant_scale.value = np.array(
+                        [127. / amax], dtype=np.float32)
+                    layer.attention.kv_quant_orig_scale.value = np.array(
+                        [amax / 127.], dtype=np.float32)
             # Prepare
             network.set_named_parameters(tensorrt_llm_llama.named_parameters())
             inputs = tensorrt_llm_llama.prepare_inputs(batch_size, input_len,
@@ -100,7 +162,8 @@ class TestLLaMA(unittest.TestCase):
                                  use_refit,
                                  fast_building=False,
                                  context_fmha_flag=ContextFMHAType.disabled,
-                                 enable_remove_input_padding=False):
+                                 enable_remove_input_padding=False,
+                                 kv_cache_amax=None):
 
         builder = Builder()
 
@@ -116,7 +179,8 @@ class TestLLaMA(unittest.TestCase):
 
             self._gen_tensorrt_llm_network(network, hf_llama, llama_config,
                                            batch_size, beam_width, input_len,
-                                           output_len, dtype, rank, world_size)
+                                           output_len, dtype, rank, world_size,
+                                           kv_cache_amax)
 
             builder_config = builder.create_builder_config(
                 name=model_name,
@@ -124,6 +188,7 @@ class TestLLaMA(unittest.TestCase):
                 timing_cache='model.cache',
                 tensor_parallel=world_size,  # TP only
                 use_refit=use_refit,
+                int8=kv_cache_amax is not None,
             )
             engine_buffer = builder.build_engine(network, builder_config)
             return engine_buffer
@@ -144,18 +209,33 @@ class TestLLaMA(unittest.TestCase):
                                   use_refit,
                                   fast_building=False,
                                   context_fmha_flag=ContextFMHAType.disabled,
-                                  enable_remove_input_padding=False):
+                                  enable_remove_input_padding=False,
+                                  kv_cache_amax=None):
         tensorrt_llm.logger.set_level(log_level)
         mapping = tensorrt_llm.Mapping(world_size, rank, tp_size=world_size)
         engine_buffer = self._gen_tensorrt_llm_engine(
             dtype, rank, world_size, llama_config, hf_llama, model_name,
             use_plugin, batch_size, beam_width, input_len, output_len,
             use_refit, fast_building, context_fmha_flag,
-            enable_remove_input_padding)
+            enable_remove_input_padding, kv_cache_amax)
         runtime = tensorrt_llm.runtime.generation._Runtime(
             engine_buffer, mapping)
         return runtime, engine_buffer
 
+    def _calibrate_kv_cache_amax(self, hf_llama, batch_size, max_seq_len):
+        # Per-layer absmax of the K/V cache over a calibration batch. A
+        # dedicated generator keeps the test's own random inputs unchanged.
+        generator = torch.Generator().manual_seed(0)
+        calib_ids = torch.randint(100, (8 * batch_size, max_seq_len),
+                                  generator=generator).cuda()
+        with torch.inference_mode():
+            past_key_values = hf_llama.forward(calib_ids,
+                                               use_cache=True).past_key_values
+        return [
+            max(k.abs().max().item(),
+                v.abs().max().item()) for k, v in past_key_values
+        ]
+
     def load_test_cases():
         test_cases = list(
             product([False], [False, True], [
@@ -174,6 +254,10 @@ class TestLLaMA(unittest.TestCase):
             (False, True, ContextFMHAType.enabled, False, 'float16', 2))  # GQA
         test_cases.append((False, True, ContextFMHAType.enabled_with_fp32_acc,
                            False, 'float16', 4))  # GQA
+        test_cases.append((False, True, ContextFMHAType.disabled, False,
+                           'float16', 0, True))  # INT8 KV cache
+        test_cases.append((False, True, ContextFMHAType.disabled, True,
+                           'float16', 2, True))  # GQA + INT8 KV cache
         return test_cases
 
     def custom_name_func(testcase_func, param_num, param):
@@ -183,8 +267,14 @@ class TestLLaMA(unittest.TestCase):
         )
 
     @parameterized.expand(load_test_cases, name_func=custom_name_func)
-    def test_llama(self, use_refit, fast_building, context_fmha_flag,
-                   enable_remove_input_padding, dtype, num_kv_heads):
+    def test_llama(self,
+                   use_refit,
+                   fast_building,
+                   context_fmha_flag,
+                   enable_remove_input_padding,
+                   dtype,
+                   num_kv_heads,
+                   use_int8_kv_cache=False):
 
         # Skip tests that are not supported in pre-ampere architecture
         if getSMVersion() < 80:
@@ -230,26 +320,24 @@ class TestLLaMA(unittest.TestCase):
         llama_config.pad_token_id = self.PAD_TOKEN
         llama_config.eos_token_id = self.EOS_TOKEN
         seed_idx = random.randint(0, len(PRECHECKED_GOOD_RANDOM_SEEDS) - 1)
-        torch.manual_seed(PRECHECKED_GOOD_RANDOM_SEEDS[seed_idx])
-        hf_llama = LlamaForCausalLM(llama_config).cuda()
+        hf_llama = self._gen_hf_llama(llama_config,
+                                      PRECHECKED_GOOD_RANDOM_SEEDS[seed_idx])
+        kv_cache_amax = None
+        if use_int8_kv_cache:
+            kv_cache_amax = self._calibrate_kv_cache_amax(
+                hf_llama, batch_size, max_seq_len)
         runtime, _ = self._gen_tensorrt_llm_runtime(
             log_level, dtype, world_size, rank, llama_config, hf_llama, model,
             use_plugin, batch_size, beam_width, input_len, output_len,
             use_refit, fast_building, context_fmha_flag,
-            enable_remove_input_padding)
-        key_value_cache_buffers = []
+            enable_remove_input_padding, kv_cache_amax)
         head_size = llama_config.hidden_size // llama_config.num_attention_heads
-        for i in range(llama_config.num_hidden_layers):
-            key_value_cache_buffers.append(
-                torch.zeros((
-                    batch_size,
-                    2,
-                    llama_config.num_key_value_heads,
-                    max_seq_len,
-                    head_size,
-                ),
-                            dtype=tensorrt_llm._utils.str_dtype_to_torch(dtype),
-                            device='cuda'))
+        kv_cache_dtype = torch.int8 if use_int8_kv_cache else \
+            tensorrt_llm._utils.str_dtype_to_torch(dtype)
+        key_value_cache_buffers = self._get_kv_cache_buffers(
+            llama_config.num_hidden_layers,
+            (batch_size, 2, llama_config.num_key_value_heads, max_seq_len,
+             head_size), kv_cache_dtype)
 
         # compare context
         step = 0
@@ -269,7 +357,7 @@ class TestLLaMA(unittest.TestCase):
         # and it will be added one after each step.
         sequence_length_buffer = ctx_context_lengths.detach().clone()
 
-        with torch.no_grad():
+        with torch.inference_mode():
             hf_outputs = hf_llama.forward(ctx_ids)
         torch.cuda.synchronize()
         ref = hf_outputs.logits[:, -1, :]
@@ -316,6 +404,10 @@ class TestLLaMA(unittest.TestCase):
                     max_seq_len, head_size)
         for i in range(llama_config.num_hidden_layers):
             ctx_shape[f'past_key_value_{i}'] = kv_shape
+            # The KV cache is updated in place, so the present output must
+            # be bound to the same buffer as the past input. _set_buffer
+            # allocates a fresh zeroed buffer for any unbound output, so
+            # both names are needed.
             ctx_buffer[f'past_key_value_{i}'] = key_value_cache_buffers[i]
             ctx_buffer[f'present_key_value_{i}'] = key_value_cache_buffers[i]
         ctx_buffer['sequence_length'] = sequence_length_buffer
@@ -344,7 +436,7 @@ class TestLLaMA(unittest.TestCase):
         gen_host_request_types = torch.tensor([1] * batch_size,
                                               dtype=torch.int32)
 
-        with torch.no_grad():
+        with torch.inference_mode():
             hf_outputs = hf_llama.forward(
                 step1_id,
                 past_key_values=hf_outputs.past_key_values,
@@ -374,11 +466,11 @@ class TestLLaMA(unittest.TestCase):
 
         for i in range(llama_config.num_hidden_layers):
             step1_shape[f'past_key_value_{i}'] = kv_shape
-        step1_shape['sequence_length'] = (batch_size, )
-        step1_shape['host_past_key_value_lengths'] = (batch_size, )
-        for i in range(llama_config.num_hidden_layers):
+            # in-place KV cache update, see the context step above
             step1_buffer[f'past_key_value_{i}'] = key_value_cache_buffers[i]
             step1_buffer[f'present_key_value_{i}'] = key_value_cache_buffers[i]
+        step1_shape['sequence_length'] = (batch_size, )
+        step1_shape['host_past_key_value_lengths'] = (batch_size, )
         step1_buffer[
             'host_past_key_value_lengths'] = sequence_length_buffer.cpu()
         sequence_length_buffer = torch.add(sequence_length_buffer, step)